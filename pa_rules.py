@@ -0,0 +1,252 @@
+import pandas as pd
+import numpy as np
+import re
+
+# ─────────────────────────────────────────────────────
+# PA rule engine: vectorized answers to the 13 PA-form
+# questions. Lives outside the Streamlit script so that
+# process-pool workers can import and pickle `process`.
+# ─────────────────────────────────────────────────────
+
+KEYWORDS = {
+    "Upper Extremity": ["shoulder","elbow","wrist","hand","arm"],
+    "Lower Extremity": ["hip","thigh","knee","ankle","foot","leg"],
+    "Spine/Trunk":     ["spine","back","lumbar","thoracic","cervical"],
+    "Head/Face/Jaw":   ["head","face","jaw","tmj","concussion"],
+}
+PREFIX_BUCKETS = {
+    "Upper Extremity": ("M75","S4","S43","S45"),
+    "Lower Extremity": ("M17","S83","S82","S86"),
+    "Spine/Trunk":     ("M54","S23","S33","M51","M50"),
+    "Head/Face/Jaw":   ("S02","S06"),
+}
+ICD_LATERALITY = {"1":"Right","2":"Left","3":"Bilateral"}
+SURGERY_KW = {
+    "Joint Replacement Surgery": ["replacement","arthroplasty","tkr"],
+    "Arthroscopic/Minimally Invasive Joint Surgery": ["arthroscopic","arthroscopy","scope"],
+    "Spine Surgery": ["laminectomy","fusion","discectomy"],
+    "Fracture/Trauma Repair": ["fracture","orif","hardware","fixation"],
+}
+SPECIAL_TESTS = ["lachman","hawkins","phalen","drawer","apprehension"]
+
+def alternation(kws):
+    return "|".join(map(re.escape, kws))
+
+# One alternation per bucket: a single C-level scan of the blob replaces
+# a Python loop over substrings. Kept as pattern strings (matched with
+# case=False) so they dispatch to Arrow's regex kernel.
+SURGERY_PATTERNS = {cat: alternation(kws) for cat, kws in SURGERY_KW.items()}
+SPECIAL_TESTS_PATTERN = alternation(SPECIAL_TESTS)
+BILATERAL_PATTERN = r"\bbilat(?:er(?:al)?)?\b|\bboth\b"
+ROM_PATTERN      = "limited|restriction|rom"
+STRENGTH_PATTERN = "/5|weak|deficit"
+
+# The three assessment-driven findings share one scan of the field; the
+# named group of each match tags which label it belongs to.
+ASSESS_PATTERN = ("(?i)(?P<pain>pain|tender|swelling)"
+                 "|(?P<gait>gait|balance)"
+                 f"|(?P<special>{SPECIAL_TESTS_PATTERN})")
+ASSESS_LABELS = {"pain": "Pain/Swelling",
+                 "gait": "Balance/Gait Impaired",
+                 "special": "Positive Special Tests"}
+
+# All four body-part keyword buckets in one pass over the blob, using
+# the same named-group tagging trick. Tag order follows KEYWORDS so the
+# group index doubles as the mask bit position.
+PART_TAGS = dict(zip(("upper","lower","spine","head"), KEYWORDS))
+BODY_PATTERN = "(?i)" + "|".join(
+    f"(?P<{tag}>{alternation(KEYWORDS[cat])})" for tag, cat in PART_TAGS.items()
+)
+
+# Text columns consumed by the rule engine; stored Arrow-backed so the
+# str.contains / str.lower / str.slice scans run in Arrow's C++ kernels.
+STRING_DTYPE = "string[pyarrow]"
+TEXT_COLS = ("Primary_Diagnosis_Code","Diagnosis_Description","Assessment",
+             "Range_of_Motion","Strength","Justification_for_PT","Had_Surgery")
+
+# Every input column the generator consumes; anything else in an upload
+# is dead weight for parsing and memory.
+DATE_COLS = ("Date_of_Birth","Date_of_Injury_Onset","Date_of_Surgery")
+NEEDED_COLS = frozenset(("Patient_ID","Patient_Name","Insurance_Payer",
+                         "Policy_Number","Referring_Physician")
+                        + DATE_COLS + TEXT_COLS)
+
+def prepare(df):
+    for c in TEXT_COLS:
+        if c in df.columns:
+            df[c] = df[c].astype(STRING_DTYPE)
+    return df
+
+def contains(blob, pat, regex=True):
+    return blob.str.contains(pat, case=False, regex=regex, na=False).to_numpy(dtype=bool)
+
+# Single anchored alternation over every prefix (longest first, so e.g.
+# S43 wins over S4) plus a flat prefix -> category map: the ICD column
+# is bucketed in one extract pass over the codes.
+PREFIX_TO_PART = {p: cat for cat, prefs in PREFIX_BUCKETS.items() for p in prefs}
+ICD_PREFIX_PATTERN = "^(" + "|".join(
+    map(re.escape, sorted(PREFIX_TO_PART, key=len, reverse=True))) + ")"
+
+# Decode table for the 4-bit body-part match masks: exactly one bit set
+# maps to that category, several bits to "Multiple Areas / Systemic",
+# none to "". Indexing the table replaces the branchy select per row.
+PART_CATEGORIES = list(KEYWORDS) + ["Multiple Areas / Systemic", ""]
+
+# Fixed category lists for the other enumerated outputs: per-chunk
+# results built against the same categories concatenate without
+# degrading back to object dtype.
+SIDE_CATEGORIES    = ["Right","Left","Bilateral","Not Applicable",""]
+SURGERY_CATEGORIES = list(SURGERY_KW) + ["Other Orthopedic/Soft Tissue Surgery",""]
+YESNO_CATEGORIES   = ["Yes","No"]
+PART_LUT = np.empty(16, dtype=np.int8)
+for _m in range(16):
+    _bits = bin(_m).count("1")
+    if _bits == 0:
+        PART_LUT[_m] = len(PART_CATEGORIES) - 1
+    elif _bits == 1:
+        PART_LUT[_m] = _m.bit_length() - 1
+    else:
+        PART_LUT[_m] = len(PART_CATEGORIES) - 2
+
+def text_col(df, name):
+    if name in df.columns:
+        return df[name].fillna("")
+    return pd.Series("", index=df.index, dtype=STRING_DTYPE)
+
+def date_col(df, name):
+    if name not in df.columns:
+        return pd.Series("", index=df.index)
+    raw = df[name]
+    # format="mixed" parses each element independently like the old
+    # scalar formatter did; the default would lock onto the first
+    # value's format and coerce every other valid format to NaT
+    parsed = pd.to_datetime(raw, format="mixed", errors="coerce")
+    out = parsed.dt.strftime("%d-%m-%Y")
+    # unparseable but non-empty values fall back to their raw text,
+    # matching the old scalar formatter
+    fallback = parsed.isna() & raw.notna() & (raw.astype(str) != "")
+    return pd.Series(np.where(fallback, raw.astype(str), out.fillna("")), index=df.index)
+
+# ─── Q7: Body Part ─────────────────────────────────────────
+
+def body_part(icd, blob):
+    icd_part = icd.str.extract(ICD_PREFIX_PATTERN, expand=False).map(PREFIX_TO_PART)
+    kw_hits = blob.str.extractall(BODY_PATTERN).notna().groupby(level=0).any()
+    # One bit per category: the match state of a row is a uint8 mask, so
+    # counting and decoding matches are plain integer array ops.
+    mask = np.zeros(len(blob), dtype=np.uint8)
+    for i, (tag, cat) in enumerate(PART_TAGS.items()):
+        if tag in kw_hits.columns:
+            kw = kw_hits[tag].reindex(blob.index, fill_value=False).to_numpy(dtype=bool)
+        else:
+            kw = np.zeros(len(blob), dtype=bool)
+        hit = (icd_part == cat).to_numpy(dtype=bool) | kw
+        mask |= hit.astype(np.uint8) << i
+    codes = PART_LUT[mask]
+    return pd.Series(pd.Categorical.from_codes(codes, PART_CATEGORIES), index=blob.index)
+
+# ─── Q8: Side ────────────────────────────────────────────────
+
+def side(icd, blob, part):
+    lat = icd.str.slice(4, 5).map(ICD_LATERALITY)
+    # conditions in precedence order: ICD laterality digit wins, then the
+    # textual scans, then the not-applicable body parts
+    conds = [lat.notna().to_numpy(dtype=bool),
+             contains(blob, BILATERAL_PATTERN),
+             contains(blob, "left", regex=False),
+             contains(blob, "right", regex=False),
+             part.isin(["Spine/Trunk","Head/Face/Jaw"]).to_numpy(dtype=bool)]
+    choices = [lat.fillna(""), "Bilateral", "Left", "Right", "Not Applicable"]
+    return pd.Series(np.select(conds, choices, default=""), index=blob.index)
+
+# ─── Q12: Surgery Type ───────────────────────────────────────
+
+def surgery_type(blob, surg):
+    # only surgical rows get a label: scan just that subset and scatter
+    # the results back instead of classifying every row and masking
+    out = np.full(len(blob), "", dtype=object)
+    if surg.any():
+        sub = blob[surg]
+        conds = [contains(sub, pat) for pat in SURGERY_PATTERNS.values()]
+        out[surg] = np.select(conds, list(SURGERY_KW),
+                              default="Other Orthopedic/Soft Tissue Surgery")
+    return pd.Series(out, index=blob.index)
+
+# ─── Q13: Objective Findings ─────────────────────────────────
+
+def findings(rom, stren, asses):
+    hits = asses.str.extractall(ASSESS_PATTERN).notna().groupby(level=0).any()
+
+    def assess_mask(tag):
+        if tag in hits.columns:
+            return hits[tag].reindex(asses.index, fill_value=False).to_numpy(dtype=bool)
+        return np.zeros(len(asses), dtype=bool)
+
+    labelled = [
+        (contains(rom, ROM_PATTERN), "Restricted ROM"),
+        (contains(stren, STRENGTH_PATTERN), "Strength Deficits"),
+    ] + [(assess_mask(tag), label) for tag, label in ASSESS_LABELS.items()]
+    out = np.full(len(asses), "", dtype=object)
+    for mask, label in labelled:
+        out = np.where(mask, np.where(out == "", label, out + "; " + label), out)
+    return pd.Series(out, index=asses.index)
+
+# ─── Core generator ──────────────────────────────────────────
+
+def generate(df):
+    # Normalize each free-text column once and share the concatenated
+    # blobs across the rules instead of rebuilding them per question.
+    icd   = text_col(df, "Primary_Diagnosis_Code")
+    desc  = text_col(df, "Diagnosis_Description")
+    asses = text_col(df, "Assessment")
+    rom   = text_col(df, "Range_of_Motion")
+    stren = text_col(df, "Strength")
+    just  = text_col(df, "Justification_for_PT")
+    blob_q7  = desc + " " + asses
+    blob_q8  = blob_q7 + " " + rom + " " + stren
+    blob_q12 = blob_q7 + " " + just
+
+    part = body_part(icd, blob_q7)
+    sd   = side(icd, blob_q8, part)
+    surg = text_col(df, "Had_Surgery").str.lower().isin(("yes","y","true","1")).to_numpy(dtype=bool)
+    results = pd.DataFrame({
+        "Patient_ID": df.get("Patient_ID"),
+        "Name": df.get("Patient_Name"),
+        "DOB": date_col(df, "Date_of_Birth"),
+        "Payer": df.get("Insurance_Payer"),
+        "Policy#": df.get("Policy_Number"),
+        "Ref_MD": df.get("Referring_Physician"),
+        "ICD10": df.get("Primary_Diagnosis_Code"),
+        "Body_Part": part,
+        "Side": sd,
+        "Injury_Date": date_col(df, "Date_of_Injury_Onset"),
+        "Had_Surgery": np.where(surg, "Yes", "No"),
+        "Surgery_Date": np.where(surg, date_col(df, "Date_of_Surgery"), ""),
+        "Surgery_Type": surgery_type(blob_q12, surg),
+        "Objective_Findings": findings(rom, stren, asses),
+    })
+    # The enumerated columns take a handful of distinct values each;
+    # category dtype stores integer codes instead of N Python strings.
+    # Body_Part is already categorical via the LUT decode.
+    for col, cats in (("Side", SIDE_CATEGORIES),
+                      ("Had_Surgery", YESNO_CATEGORIES),
+                      ("Surgery_Type", SURGERY_CATEGORIES)):
+        results[col] = pd.Categorical(results[col], categories=cats)
+    miss_bp   = (results["Body_Part"] == "").to_numpy()
+    miss_side = (results["Side"] == "").to_numpy()
+    bad_surg  = surg & (results["Surgery_Date"] == "").to_numpy()
+    flagged   = miss_bp | miss_side | bad_surg
+    # issue text by mask algebra: concatenate the applicable labels and
+    # strip the trailing separator
+    issues = pd.Series(np.where(miss_bp, "Missing Body_Part; ", "")
+                       + np.where(miss_side, "Missing Side; ", "")
+                       + np.where(bad_surg, "Surgery flagged without date; ", ""),
+                       index=results.index).str.rstrip("; ")
+    anomalies = results.assign(Issue=issues)[flagged]
+    anomalies = anomalies[["Issue"] + list(results.columns)]
+    return results, anomalies
+
+def process(df):
+    # Entry point for pool workers: prepare raw upload columns, then
+    # run the rule engine.
+    return generate(prepare(df))
@@ -1,7 +1,17 @@
 import streamlit as st
 import pandas as pd
-import re
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
+import openpyxl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import chain
+
+from pa_rules import process, NEEDED_COLS, STRING_DTYPE, TEXT_COLS
 
 # ─────────────────────────────────────────────────────
 # Streamlit App: PA Response Generator
@@ -21,142 +31,106 @@ st.markdown(
     """
 )
 
-# ─────────────────────────────────────────────────────
-# Helper functions & rule sets
-# ─────────────────────────────────────────────────────
+# ─────────────────────────────────────────────────────────────
+# Cached loading & generation
+# ─────────────────────────────────────────────────────────────
+
+CHUNK_ROWS = 100_000
 
-def std(text: str) -> str:
-    return str(text).lower()
-
-KEYWORDS = {
-    "Upper Extremity": ["shoulder","elbow","wrist","hand","arm"],
-    "Lower Extremity": ["hip","thigh","knee","ankle","foot","leg"],
-    "Spine/Trunk":     ["spine","back","lumbar","thoracic","cervical"],
-    "Head/Face/Jaw":   ["head","face","jaw","tmj","concussion"],
-}
-PREFIX_BUCKETS = {
-    "Upper Extremity": ("M75","S4","S43","S45"),
-    "Lower Extremity": ("M17","S83","S82","S86"),
-    "Spine/Trunk":     ("M54","S23","S33","M51","M50"),
-    "Head/Face/Jaw":   ("S02","S06"),
-}
-ICD_LATERALITY = {"1":"Right","2":"Left","3":"Bilateral"}
-SURGERY_KW = {
-    "Joint Replacement Surgery": ["replacement","arthroplasty","tkr"],
-    "Arthroscopic/Minimally Invasive Joint Surgery": ["arthroscopic","arthroscopy","scope"],
-    "Spine Surgery": ["laminectomy","fusion","discectomy"],
-    "Fracture/Trauma Repair": ["fracture","orif","hardware","fixation"],
-}
-SPECIAL_TESTS = ["lachman","hawkins","phalen","drawer","apprehension"]
-
-def any_kw(text: str, kws: list[str]) -> bool:
-    t = std(text)
-    return any(k in t for k in kws)
-
-def fmt_date(val) -> str:
-    if pd.isna(val) or val == "":
-        return ""
+def iter_excel_chunks(data: bytes, chunk_rows: int):
+    # openpyxl's read-only mode streams the sheet XML row by row instead
+    # of materializing the whole workbook DOM.
+    wb = openpyxl.load_workbook(BytesIO(data), read_only=True, data_only=True)
     try:
-        return pd.to_datetime(val).strftime("%d-%m-%Y")
-    except:
-        return str(val)
-
-# ─── Q7: Body Part ─────────────────────────────────────────
-
-def body_part(row):
-    matches = set()
-    icd = str(row.get("Primary_Diagnosis_Code",""))
-    blob = (str(row.get("Diagnosis_Description","")) + " " + str(row.get("Assessment",""))).lower()
-    for cat,pref in PREFIX_BUCKETS.items():
-        if icd.startswith(pref):
-            matches.add(cat)
-    for cat,kws in KEYWORDS.items():
-        if any_kw(blob,kws):
-            matches.add(cat)
-    if len(matches)==1:
-        return matches.pop()
-    if len(matches)>1:
-        return "Multiple Areas / Systemic"
-    return ""
-
-# ─── Q8: Side ────────────────────────────────────────────────
-
-def side(row, part):
-    icd = str(row.get("Primary_Diagnosis_Code",""))
-    if len(icd)>=5 and icd[4] in ICD_LATERALITY:
-        return ICD_LATERALITY[icd[4]]
-    blob = " ".join(str(row.get(c,"")).lower() for c in ["Diagnosis_Description","Assessment","Range_of_Motion","Strength"])
-    if re.search(r"\bbilat(er(al)?)?\b|\bboth\b",blob):
-        return "Bilateral"
-    if "left" in blob:
-        return "Left"
-    if "right" in blob:
-        return "Right"
-    if part in ["Spine/Trunk","Head/Face/Jaw"]:
-        return "Not Applicable"
-    return ""
-
-# ─── Q12: Surgery Type ───────────────────────────────────────
-
-def surgery_type(row):
-    if std(row.get("Had_Surgery","")) not in ("yes","y","true","1"): return ""
-    blob = " ".join(str(row.get(c,"")).lower() for c in ["Diagnosis_Description","Assessment","Justification_for_PT"])
-    for cat,kws in SURGERY_KW.items():
-        if any_kw(blob,kws):
-            return cat
-    return "Other Orthopedic/Soft Tissue Surgery"
-
-# ─── Q13: Objective Findings ─────────────────────────────────
-
-def findings(row):
-    out=[]
-    rom = std(row.get("Range_of_Motion",""))
-    stren= std(row.get("Strength",""))
-    asses= std(row.get("Assessment",""))
-    if any(x in rom for x in ["limited","restriction"]) or "rom" in rom:
-        out.append("Restricted ROM")
-    if any(x in stren for x in ["/5","weak","deficit"]):
-        out.append("Strength Deficits")
-    if any(x in asses for x in ["pain","tender","swelling"]):
-        out.append("Pain/Swelling")
-    if any(x in asses for x in ["gait","balance"]):
-        out.append("Balance/Gait Impaired")
-    if any_kw(asses,SPECIAL_TESTS):
-        out.append("Positive Special Tests")
-    return "; ".join(out)
-
-# ─── Core generator ──────────────────────────────────────────
-
-def generate(df):
-    rows, anomalies = [],[]
-    for _,r in df.iterrows():
-        part = body_part(r)
-        sd   = side(r,part)
-        surg = std(r.get("Had_Surgery","")) in ("yes","y","true","1")
-        rec={
-            "Patient_ID":r.get("Patient_ID"),
-            "Name":r.get("Patient_Name"),
-            "DOB":fmt_date(r.get("Date_of_Birth")),
-            "Payer":r.get("Insurance_Payer"),
-            "Policy#":r.get("Policy_Number"),
-            "Ref_MD":r.get("Referring_Physician"),
-            "ICD10":r.get("Primary_Diagnosis_Code"),
-            "Body_Part":part,
-            "Side":sd,
-            "Injury_Date":fmt_date(r.get("Date_of_Injury_Onset")),
-            "Had_Surgery":"Yes" if surg else "No",
-            "Surgery_Date":fmt_date(r.get("Date_of_Surgery")) if surg else "",
-            "Surgery_Type":surgery_type(r),
-            "Objective_Findings":findings(r)
-        }
-        rows.append(rec)
-        issues=[]
-        if rec["Body_Part"]=="": issues.append("Missing Body_Part")
-        if rec["Side"]=="": issues.append("Missing Side")
-        if surg and rec["Surgery_Date"]=="": issues.append("Surgery flagged without date")
-        if issues:
-            anomalies.append({"Issue":"; ".join(issues),**rec})
-    return pd.DataFrame(rows), pd.DataFrame(anomalies)
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = list(header)
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) == chunk_rows:
+                yield pd.DataFrame(buffer, columns=header)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=header)
+    finally:
+        wb.close()
+
+def iter_chunks(data: bytes, name: str):
+    if name.endswith(".csv"):
+        # skip unused columns entirely and land the text columns directly
+        # in their Arrow dtype instead of inferring object columns first
+        yield from pd.read_csv(BytesIO(data), chunksize=CHUNK_ROWS,
+                               usecols=lambda c: c in NEEDED_COLS,
+                               dtype={c: STRING_DTYPE for c in TEXT_COLS})
+    elif name.endswith(".xlsx"):
+        yield from iter_excel_chunks(data, CHUNK_ROWS)
+    else:
+        # legacy .xls has no streaming reader; load it whole
+        yield pd.read_excel(BytesIO(data))
+
+# Streamlit re-runs the whole script on every widget interaction; caching
+# on the raw upload bytes means the parse and the rule engine only run
+# when a new file arrives. Files are read in chunks and multi-chunk files
+# fan out across cores (chunks share no state); submission is throttled
+# to a small window of in-flight chunks so peak memory stays bounded by
+# that window plus the (much smaller) accumulated outputs.
+
+@st.cache_data(show_spinner="Processing patient file…")
+def process_patients(data: bytes, name: str):
+    reader = iter_chunks(data, name)
+    try:
+        first = next(reader)
+    except StopIteration:
+        return process(pd.DataFrame())
+    try:
+        second = next(reader)
+    except StopIteration:
+        outputs = [process(first)]  # single chunk: skip pool startup
+    else:
+        # Executor.map would pickle every chunk up front; keep only a
+        # bounded window in flight, draining in submission order.
+        window_size = 2 * (os.cpu_count() or 1)
+        with ProcessPoolExecutor() as ex:
+            outputs = []
+            pending = deque()
+            for chunk in chain([first, second], reader):
+                pending.append(ex.submit(process, chunk))
+                if len(pending) >= window_size:
+                    outputs.append(pending.popleft().result())
+            outputs.extend(fut.result() for fut in pending)
+    frames, anom_frames = zip(*outputs)
+    return (pd.concat(frames, ignore_index=True),
+            pd.concat(anom_frames, ignore_index=True))
+
+def cat_counts(s: pd.Series) -> pd.DataFrame:
+    # np.bincount over the category codes: one linear integer pass
+    # instead of hashed counting, at most len(categories) output rows.
+    if not isinstance(s.dtype, pd.CategoricalDtype):
+        s = s.astype("category")  # chunk concat can degrade dtype
+    codes = s.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(s.cat.categories))
+    out = pd.DataFrame({s.name: list(s.cat.categories), "Count": counts})
+    return out[out["Count"] > 0]
+
+@st.cache_data(show_spinner=False)
+def summary_counts(results: pd.DataFrame) -> dict:
+    # one cached aggregation serves all three charts across reruns
+    return {
+        "Body_Part": cat_counts(results["Body_Part"].cat.rename_categories({"": "Unknown"})),
+        "Side": cat_counts(results["Side"].cat.rename_categories({"": "Unknown"})),
+        "Had_Surgery": cat_counts(results["Had_Surgery"]),
+    }
+
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(results: pd.DataFrame) -> bytes:
+    # Arrow writes UTF-8 bytes in one columnar pass; pandas' to_csv would
+    # build the whole payload as a Python string and re-encode it.
+    buf = BytesIO()
+    pacsv.write_csv(pa.Table.from_pandas(results, preserve_index=False), buf)
+    return buf.getvalue()
 
 # ─────────────────────────────────────────────────────────────
 # UI Workflow
@@ -164,34 +138,31 @@ def generate(df):
 
 uploaded = st.file_uploader("Upload patient dataset", type=["csv","xlsx","xls"])
 if uploaded:
-    df = pd.read_csv(uploaded) if uploaded.name.endswith(".csv") else pd.read_excel(uploaded)
-    results, anoms = generate(df)
+    results, anoms = process_patients(uploaded.getvalue(), uploaded.name)
     st.success(f"Processed {len(results)} patients ✅")
 
     st.subheader("PA Responses")
     st.dataframe(results, use_container_width=True, height=350)
-    st.download_button("Download CSV", results.to_csv(index=False).encode(), "pa_responses.csv", mime="text/csv")
+    st.download_button("Download CSV", to_csv_bytes(results), "pa_responses.csv", mime="text/csv")
 
     st.markdown("---")
     st.subheader("Summary Visuals")
+    counts = summary_counts(results)
     c1,c2,c3 = st.columns(3)
     with c1:
-        bp_df = results["Body_Part"].replace("","Unknown").value_counts().reset_index()
-        bp_df.columns = ["Body_Part","Count"]
-        fig1 = px.bar(bp_df, x="Body_Part", y="Count", title="Body Part Distribution")
-        fig1.update_layout(margin=dict(l=20,r=20,t=30,b=20))
+        bp_df = counts["Body_Part"]
+        fig1 = go.Figure(go.Bar(x=bp_df["Body_Part"], y=bp_df["Count"]))
+        fig1.update_layout(title="Body Part Distribution", margin=dict(l=20,r=20,t=30,b=20))
         st.plotly_chart(fig1, use_container_width=True)
     with c2:
-        sd_df = results["Side"].replace("","Unknown").value_counts().reset_index()
-        sd_df.columns=["Side","Count"]
-        fig2 = px.pie(sd_df, names="Side", values="Count", title="Affected Side", hole=0.4)
-        fig2.update_layout(margin=dict(l=20,r=20,t=30,b=20))
+        sd_df = counts["Side"]
+        fig2 = go.Figure(go.Pie(labels=sd_df["Side"], values=sd_df["Count"], hole=0.4))
+        fig2.update_layout(title="Affected Side", margin=dict(l=20,r=20,t=30,b=20))
         st.plotly_chart(fig2, use_container_width=True)
     with c3:
-        sg_df = results["Had_Surgery"].value_counts().reset_index()
-        sg_df.columns=["Had_Surgery","Count"]
-        fig3 = px.bar(sg_df, x="Had_Surgery", y="Count", title="Surgery Yes/No")
-        fig3.update_layout(margin=dict(l=20,r=20,t=30,b=20))
+        sg_df = counts["Had_Surgery"]
+        fig3 = go.Figure(go.Bar(x=sg_df["Had_Surgery"], y=sg_df["Count"]))
+        fig3.update_layout(title="Surgery Yes/No", margin=dict(l=20,r=20,t=30,b=20))
         st.plotly_chart(fig3, use_container_width=True)
 
     st.markdown("---")